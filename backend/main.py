@@ -1,23 +1,199 @@
-from fastapi import FastAPI, HTTPException       
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
-from googleapiclient.discovery import build
-import yt_dlp
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
+from contextlib import asynccontextmanager
+import httpx
+import orjson
+from cachetools import LRUCache, TTLCache
+from itsdangerous import BadSignature, TimestampSigner
+import anyio.to_thread
+import asyncio
+import hashlib
+import secrets
 import os
+import shutil
+import sys
+import time
+import re
+from urllib.parse import urlparse, parse_qs
 from dotenv import load_dotenv
 from mangum import Mangum
-import io
 import logging
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+# Set up logging: one JSON object per line so serverless log aggregation
+# keeps records (and tracebacks) intact
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"lvl": record.levelname, "logger": record.name, "msg": record.getMessage()}
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry).decode()
 
 load_dotenv()
 
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(JsonFormatter())
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+log_level_valid = isinstance(logging.getLevelName(LOG_LEVEL), int)
+logging.basicConfig(level=LOG_LEVEL if log_level_valid else logging.INFO, handlers=[log_handler])
+logger = logging.getLogger(__name__)
+if not log_level_valid:
+    logger.warning("Unknown LOG_LEVEL %r; using INFO", LOG_LEVEL)
+
+YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY")
+YOUTUBE_VIDEOS_URL = "https://www.googleapis.com/youtube/v3/videos"
+# Read size used when forwarding encoded audio to the client
+STREAM_CHUNK_SIZE = 64 * 1024
+# yt-dlp's cache (player JS, signature functions) lives in /tmp, the only
+# writable path on Vercel, so warm invocations skip re-deriving it
+YTDLP_CACHE_DIR = os.getenv("YTDLP_CACHE_DIR", "/tmp/yt-dlp-cache")
+YTDLP_ARGS = (
+    sys.executable, "-m", "yt_dlp",
+    "--quiet", "--no-playlist",
+    "--cache-dir", YTDLP_CACHE_DIR,
+    # Keep yt-dlp's maintained default clients (including the tv fallback for
+    # when ios/web need a PO token) and make sure the iOS client, whose formats
+    # are not nsig-throttled, is among them
+    "--extractor-args", "youtube:player_client=default,ios",
+    "-o", "-",
+)
+# ffmpeg is optional: @vercel/python ships none and a static build does not fit
+# the 15 MB lambda limit. Without it yt-dlp's M4A audio is streamed untouched
+FFMPEG_BIN = os.getenv("FFMPEG_BINARY") or shutil.which("ffmpeg")
+TRANSCODE_FORMAT = "bestaudio[filesize<10M]"
+PASSTHROUGH_FORMAT = "bestaudio[ext=m4a][filesize<10M]"
+# Each download starts a fresh interpreter, so keep yt-dlp's lazy extractor
+# index enabled rather than importing every extractor module up front
+YTDLP_ENV = {k: v for k, v in os.environ.items() if k != "YTDLP_NO_LAZY_EXTRACTORS"}
+# Links are only accepted from these hosts (plus youtu.be) and must carry a
+# well-formed 11-character ID; anything else is rejected before any lookup
+YOUTUBE_HOSTS = {
+    "youtube.com", "www.youtube.com", "m.youtube.com", "music.youtube.com",
+    "youtube-nocookie.com", "www.youtube-nocookie.com",
+}
+_VIDEO_ID = re.compile(r"[A-Za-z0-9_-]{11}")
+# ISO 8601 video durations as returned by the API, e.g. PT3M33S or PT1H2M3S
+_ISO_DUR = re.compile(r"PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?")
+# Partial-response filter: only the properties the endpoints actually read
+YOUTUBE_VIDEO_FIELDS = "items(id,etag,snippet(title,channelTitle,description,thumbnails/high/url),contentDetails(duration,licensedContent))"
+# Query parameters shared by every videos.list call; only the IDs vary
+YOUTUBE_VIDEO_PARAMS = {
+    "part": "snippet,contentDetails",
+    "fields": YOUTUBE_VIDEO_FIELDS,
+}
+# The API key travels in a header rather than the query string so it never
+# shows up in request URLs, error messages or tracebacks
+YOUTUBE_HEADERS = {"Accept-Encoding": "gzip", "User-Agent": "FetchMusic/1.0 (gzip)"}
+if YOUTUBE_API_KEY:
+    YOUTUBE_HEADERS["X-Goog-Api-Key"] = YOUTUBE_API_KEY
+
+# Worker threads available to anyio.to_thread, which Starlette uses for sync
+# endpoints and iterators; the default of 40 starves under bursty traffic
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "200"))
+
+# Concurrent cache misses are coalesced into a single videos.list call for up
+# to VIDEO_BATCH_SIZE IDs (the API maximum) or VIDEO_BATCH_WINDOW seconds
+VIDEO_BATCH_SIZE = 50
+VIDEO_BATCH_WINDOW = 0.02
+
+# Shared HTTP client for YouTube Data API calls plus the batching queue. They
+# are created lazily on first use rather than in the lifespan hook, because
+# Mangum would run startup/shutdown around every invocation; created this way
+# they live as long as the event loop, which Mangum reuses across warm calls
+yt_client: httpx.AsyncClient | None = None
+video_queue: asyncio.Queue | None = None
+video_batcher_task: asyncio.Task | None = None
+
+if not YOUTUBE_API_KEY:
+    logger.warning("YOUTUBE_API_KEY environment variable is missing. API-dependent endpoints will fail.")
+
+def ensure_youtube_client():
+    """Create the shared client and batcher if the running loop has none yet."""
+    global yt_client, video_queue, video_batcher_task
+    loop = asyncio.get_running_loop()
+    if video_batcher_task is not None and not video_batcher_task.done() and video_batcher_task.get_loop() is loop:
+        return
+    if video_batcher_task is not None:
+        discard_youtube_client(loop)
+    yt_client = httpx.AsyncClient(
+        http2=True,
+        timeout=10,
+        headers=YOUTUBE_HEADERS,
+        limits=httpx.Limits(max_keepalive_connections=50),
+    )
+    video_queue = asyncio.Queue()
+    video_batcher_task = loop.create_task(video_batcher(video_queue))
 
-app = FastAPI()
+def discard_youtube_client(loop: asyncio.AbstractEventLoop):
+    """Tear down a client and batcher left over from a dead task or another loop."""
+    old_task, old_queue, old_client = video_batcher_task, video_queue, yt_client
+    old_loop = old_task.get_loop()
+    if old_loop is not loop:
+        logger.warning("Event loop changed; replacing the YouTube client and batcher")
+    elif not old_task.cancelled() and old_task.exception():
+        logger.error("YouTube batcher task died; recreating it", exc_info=old_task.exception())
+    else:
+        logger.warning("YouTube batcher task was cancelled; recreating it")
+    if old_loop.is_closed():
+        # Nothing can await the old futures or run the old client's cleanup
+        # any more; its sockets are released when the objects are collected
+        return
+
+    def teardown():
+        old_task.cancel()
+        fail_futures(
+            (future for _, future in drain_queue(old_queue)),
+            RuntimeError("YouTube batcher was replaced before this lookup ran"),
+        )
+
+    if old_loop is loop:
+        teardown()
+        loop.create_task(old_client.aclose())
+    else:
+        old_loop.call_soon_threadsafe(teardown)
+        asyncio.run_coroutine_threadsafe(old_client.aclose(), old_loop)
+
+def drain_queue(queue: asyncio.Queue):
+    while not queue.empty():
+        yield queue.get_nowait()
+
+def fail_futures(futures, error: BaseException):
+    for future in futures:
+        if not future.done():
+            future.set_exception(error)
+
+async def close_youtube_client():
+    global yt_client, video_queue, video_batcher_task
+    if video_batcher_task is not None:
+        video_batcher_task.cancel()
+    if yt_client is not None:
+        await yt_client.aclose()
+    yt_client = video_queue = video_batcher_task = None
+
+async def ensure_thread_limit():
+    """Apply THREADPOOL_SIZE to the running loop's anyio limiter if not yet set."""
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    if limiter.total_tokens != THREADPOOL_SIZE:
+        limiter.total_tokens = THREADPOOL_SIZE
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Under uvicorn, warm up eagerly and close the pool cleanly on shutdown
+    await ensure_thread_limit()
+    ensure_youtube_client()
+    try:
+        yield
+    finally:
+        await close_youtube_client()
+
+# The limiter is per event loop and Mangum skips the lifespan hook, so every
+# request checks it rather than relying on startup or a client being built
+app = FastAPI(
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+    dependencies=[Depends(ensure_thread_limit)],
+)
 
 @app.get("/debug-env")
 async def debug_env():
@@ -30,25 +206,23 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
-YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY")
-
-# Initialize YouTube Data API client without failing at startup
-youtube = None
-if YOUTUBE_API_KEY:
-    try:
-        youtube = build("youtube", "v3", developerKey=YOUTUBE_API_KEY)
-        logger.info("YouTube Data API client initialized successfully.")
-    except Exception as e:
-        logger.error(f"Failed to initialize YouTube Data API client: {str(e)}")
-else:
-    logger.warning("YOUTUBE_API_KEY environment variable is missing. API-dependent endpoints will fail.")
-
 class MusicLink(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
     url: str
+    download_token: str | None = None
+
+class MusicLinks(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
+    urls: list[str] = Field(max_length=VIDEO_BATCH_SIZE)
 
 class Metadata(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
     title: str
     channel: str
     duration: str | None
@@ -56,8 +230,273 @@ class Metadata(BaseModel):
     album: str | None
 
 class ProcessResponse(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
     metadata: Metadata
     download_available: bool
+    download_token: str | None = None
+
+class ProcessLinkResult(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
+    url: str
+    result: ProcessResponse | None = None
+    error: str | None = None
+
+# In-process caches for video metadata; entries are keyed by video ID and
+# expire after an hour since titles, durations and licensing rarely change
+VIDEO_CACHE_TTL = 3600
+video_cache: TTLCache = TTLCache(maxsize=1024, ttl=VIDEO_CACHE_TTL)
+process_cache: TTLCache = TTLCache(maxsize=1024, ttl=VIDEO_CACHE_TTL)
+# (etag, item) pairs kept past the TTL so expired entries can be revalidated
+# with If-None-Match; a 304 costs no body and reuses the stored item
+video_etags: LRUCache = LRUCache(maxsize=1024)
+
+# Signed proof from /process-link that a video passed the licensing check, so
+# /download can skip the lookup. Without a shared DOWNLOAD_TOKEN_SECRET each
+# process signs with its own key and foreign tokens just fall back to a lookup
+DOWNLOAD_TOKEN_TTL = VIDEO_CACHE_TTL
+# /process-link bodies carry a token, so they are only fresh for half its life
+# and their ETag changes every PROCESS_MAX_AGE seconds (see process_link)
+PROCESS_MAX_AGE = DOWNLOAD_TOKEN_TTL // 2
+download_signer = TimestampSigner(
+    os.getenv("DOWNLOAD_TOKEN_SECRET") or secrets.token_hex(32), salt="download"
+)
+
+def with_download_token(video_id: str, result: ProcessResponse) -> ProcessResponse:
+    if not result.download_available:
+        return result
+    token = download_signer.sign(video_id).decode()
+    return result.model_copy(update={"download_token": token})
+
+def has_download_token(video_id: str, token: str | None) -> bool:
+    if not token:
+        return False
+    try:
+        return download_signer.unsign(token, max_age=DOWNLOAD_TOKEN_TTL).decode() == video_id
+    except BadSignature:
+        return False
+
+class InvalidLinkError(ValueError):
+    """The client sent a link that is not a usable YouTube video URL."""
+
+def extract_video_id(url: str) -> str:
+    """Extract the video ID from YouTube watch, youtu.be, shorts and embed URLs."""
+    # urlparse only finds a hostname after '//', so accept links pasted without a scheme
+    u = urlparse(url if "//" in url else f"https://{url}")
+    if u.hostname == "youtu.be":
+        video_id = u.path.lstrip("/")[:11]
+    elif u.hostname in YOUTUBE_HOSTS:
+        qs = parse_qs(u.query)
+        video_id = qs["v"][0][:11] if "v" in qs else u.path.rsplit("/", 1)[-1][:11]
+    else:
+        raise InvalidLinkError(f"Not a YouTube URL: {url!r}")
+    if not _VIDEO_ID.fullmatch(video_id):
+        raise InvalidLinkError(f"Could not find a video ID in {url!r}")
+    return video_id
+
+async def start_audio_pipeline(video_id: str):
+    """Spawn yt-dlp for video_id, transcoding to MP3 through ffmpeg when available.
+
+    Returns the processes, the stream to forward, its media type and extension.
+    """
+    # Only ever hand yt-dlp a URL we built from the checked ID, never client
+    # input, and end option parsing first so it cannot be read as a flag
+    url = f"https://www.youtube.com/watch?v={video_id}"
+    if not FFMPEG_BIN:
+        ytdlp = await asyncio.create_subprocess_exec(
+            *YTDLP_ARGS, "-f", PASSTHROUGH_FORMAT, "--", url,
+            stdout=asyncio.subprocess.PIPE,
+            env=YTDLP_ENV,
+        )
+        return (ytdlp,), ytdlp.stdout, "audio/mp4", "m4a"
+
+    read_fd, write_fd = os.pipe()
+    try:
+        ytdlp = await asyncio.create_subprocess_exec(
+            *YTDLP_ARGS, "-f", TRANSCODE_FORMAT, "--", url,
+            stdout=write_fd,
+            env=YTDLP_ENV,
+        )
+        try:
+            ffmpeg = await asyncio.create_subprocess_exec(
+                FFMPEG_BIN, "-loglevel", "error",
+                "-i", "pipe:0",
+                # Emit each encoded packet immediately and skip the Xing header,
+                # which ffmpeg can only fill in by seeking back on a real file
+                "-vn", "-f", "mp3", "-write_xing", "0", "-flush_packets", "1",
+                "pipe:1",
+                stdin=read_fd,
+                stdout=asyncio.subprocess.PIPE,
+            )
+        except Exception:
+            await stop_processes(ytdlp)
+            raise
+    finally:
+        # The children hold their own copies of the pipe ends
+        os.close(read_fd)
+        os.close(write_fd)
+    return (ytdlp, ffmpeg), ffmpeg.stdout, "audio/mpeg", "mp3"
+
+async def stop_processes(*procs):
+    """Terminate any still-running processes and reap them."""
+    for proc in procs:
+        if proc.returncode is None:
+            proc.kill()
+        await proc.wait()
+
+def video_cache_key(video_id: str) -> str:
+    return f"yt:v3:videos:{video_id}"
+
+async def fetch_video(video_id: str) -> dict | None:
+    """Return the videos.list item for video_id, or None if it does not exist."""
+    video = video_cache.get(video_cache_key(video_id))
+    if video is not None:
+        return video
+
+    ensure_youtube_client()
+    future = asyncio.get_running_loop().create_future()
+    await video_queue.put((video_id, future))
+    return await future
+
+async def request_videos(video_ids: list[str]) -> dict[str, dict]:
+    """Look up video_ids in one videos.list call and cache the items found."""
+    headers = {}
+    stale = None
+    if len(video_ids) == 1:
+        # The response ETag covers the whole ID list, so only single-ID
+        # lookups can be revalidated against a previously stored item
+        stale = video_etags.get(video_cache_key(video_ids[0]))
+        if stale is not None:
+            headers["If-None-Match"] = stale[0]
+
+    r = await yt_client.get(
+        YOUTUBE_VIDEOS_URL,
+        params={**YOUTUBE_VIDEO_PARAMS, "id": ",".join(video_ids)},
+        headers=headers,
+    )
+    if r.status_code == 304 and stale is not None:
+        items = [stale[1]]
+    else:
+        r.raise_for_status()
+        items = orjson.loads(r.content).get("items", [])
+        etag = r.headers.get("etag")
+        if etag and len(video_ids) == 1 and items:
+            video_etags[video_cache_key(video_ids[0])] = (etag, items[0])
+
+    videos = {}
+    for video in items:
+        videos[video["id"]] = video
+        video_cache[video_cache_key(video["id"])] = video
+    return videos
+
+async def resolve_batch(pending: dict[str, list[asyncio.Future]]):
+    """Fetch a batch of IDs and hand each waiting request its item."""
+    try:
+        videos = await request_videos(list(pending))
+    except Exception as e:
+        for futures in pending.values():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+        return
+    for video_id, futures in pending.items():
+        for future in futures:
+            if not future.done():
+                future.set_result(videos.get(video_id))
+
+async def video_batcher(queue: asyncio.Queue):
+    """Drain queue, grouping IDs that arrive within one batch window."""
+    loop = asyncio.get_running_loop()
+    in_flight = set()
+    pending = {}
+    try:
+        while True:
+            video_id, future = await queue.get()
+            pending = {video_id: [future]}
+            deadline = loop.time() + VIDEO_BATCH_WINDOW
+            while len(pending) < VIDEO_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    video_id, future = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                pending.setdefault(video_id, []).append(future)
+
+            task = asyncio.create_task(resolve_batch(pending))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+            pending = {}
+    except BaseException as e:
+        # Don't leave callers waiting on IDs collected for an unsent batch
+        fail_futures(
+            (f for futures in pending.values() for f in futures),
+            RuntimeError("YouTube batcher stopped before this lookup ran"),
+        )
+        raise e
+
+async def build_process_response(video_id: str) -> tuple[str, ProcessResponse]:
+    """Fetch and parse a video into a ProcessResponse, paired with its ETag digest."""
+    # Fetch metadata using YouTube Data API
+    video = await fetch_video(video_id)
+    if not video:
+        raise HTTPException(status_code=404, detail="Video not found")
+
+    description = video["snippet"]["description"]
+    album = None
+    for line in description.split("\n"):
+        if "Album:" in line:
+            album = line.split("Album:")[1].strip()
+            break
+
+    # Parse duration (ISO 8601 format, e.g., PT3M33S or PT1H2M3S)
+    duration = video["contentDetails"]["duration"]
+    match = _ISO_DUR.fullmatch(duration) if duration else None
+    if match:
+        h, m, sec = (int(x or 0) for x in match.groups())
+        duration = f"{h * 60 + m}:{sec:02d}"
+    else:
+        duration = None
+
+    metadata = Metadata(
+        title=video["snippet"]["title"],
+        channel=video["snippet"]["channelTitle"],
+        duration=duration,
+        thumbnail=video["snippet"].get("thumbnails", {}).get("high", {}).get("url"),
+        album=album
+    )
+
+    # Check licensing using YouTube Data API
+    licensed_content = video["contentDetails"]["licensedContent"]
+    description_lower = video["snippet"]["description"].lower()
+    is_downloadable = not licensed_content or "creative commons" in description_lower
+
+    result = ProcessResponse(metadata=metadata, download_available=is_downloadable)
+
+    # Weak validator derived from the upstream ETag, so it changes with the video
+    yt_etag = video.get("etag", "")
+    digest = hashlib.md5(f"{video_id}:{yt_etag}".encode(), usedforsecurity=False).hexdigest()
+    return digest, result
+
+async def get_process_response(video_id: str) -> tuple[str, ProcessResponse]:
+    cached = process_cache.get(video_id)
+    if cached is None:
+        cached = await build_process_response(video_id)
+        process_cache[video_id] = cached
+    return cached
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = {tag.strip() for tag in if_none_match.split(",")}
+    return "*" in tags or etag in tags
+
+async def process_link_item(url: str) -> ProcessResponse:
+    video_id = extract_video_id(url)
+    _, result = await get_process_response(video_id)
+    return with_download_token(video_id, result)
 
 @app.get("/")
 async def root():
@@ -67,132 +506,158 @@ async def root():
 async def favicon():
     return None
 
+# Browsers only cache and revalidate GET responses, so the same lookup is
+# also exposed as GET /process-link?url=... for clients that want 304s
+@app.get("/process-link", response_model=ProcessResponse)
+async def process_link_get(url: str, request: Request, response: Response):
+    return await process_link(MusicLink(url=url), request, response)
+
 @app.post("/process-link", response_model=ProcessResponse)
-async def process_link(link: MusicLink):
+async def process_link(link: MusicLink, request: Request, response: Response):
     if not YOUTUBE_API_KEY:
         logger.error("YOUTUBE_API_KEY is missing during request.")
         raise HTTPException(status_code=500, detail="YOUTUBE_API_KEY environment variable is missing.")
-    if not youtube:
-        logger.error("YouTube Data API client not initialized.")
-        raise HTTPException(status_code=500, detail="YouTube Data API client not initialized. Please check YOUTUBE_API_KEY validity.")
 
     try:
-        # Extract video ID
-        if "watch?v=" in link.url:
-            video_id = link.url.split("v=")[1].split("&")[0] if "&" in link.url else link.url.split("v=")[1]
-            video_id = video_id.split("?")[0]
-        else:
-            video_id = link.url.split("/")[-1].split("?")[0]
-
-        # Fetch metadata using YouTube Data API
-        request = youtube.videos().list(part="snippet,contentDetails", id=video_id)
-        response = request.execute()
-        if not response["items"]:
-            raise HTTPException(status_code=404, detail="Video not found")
-        video = response["items"][0]
-
-        description = video["snippet"]["description"]
-        album = None
-        for line in description.split("\n"):
-            if "Album:" in line:
-                album = line.split("Album:")[1].strip()
-                break
-
-        # Parse duration (ISO 8601 format, e.g., PT3M33S)
-        duration = video["contentDetails"]["duration"]
-        if duration:
-            duration = duration.replace("PT", "").replace("S", "")
-            minutes = 0
-            if "M" in duration:
-                minutes = int(duration.split("M")[0])
-                seconds = int(duration.split("M")[1]) if duration.split("M")[1] else 0
-            else:
-                seconds = int(duration)
-            duration = f"{minutes}:{seconds:02d}"
-
-        metadata = Metadata(
-            title=video["snippet"]["title"],
-            channel=video["snippet"]["channelTitle"],
-            duration=duration,
-            thumbnail=video["snippet"]["thumbnails"].get("high", {}).get("url"),
-            album=album
-        )
+        video_id = extract_video_id(link.url)
 
-        # Check licensing using YouTube Data API
-        licensed_content = video["contentDetails"]["licensedContent"]
-        description_lower = video["snippet"]["description"].lower()
-        is_downloadable = not licensed_content or "creative commons" in description_lower
+        digest, result = await get_process_response(video_id)
+        # The download token in the body is part of the validated representation,
+        # so max-age is kept shorter than the token lifetime: the ETag also names
+        # the PROCESS_MAX_AGE window the token was issued in, and a 304 is only
+        # given within that window. A revalidated body's token is therefore at
+        # most one window old and stays valid for the max-age that follows.
+        epoch = int(time.time()) // PROCESS_MAX_AGE
+        etag = f'W/"{digest}-{epoch}"'
 
-        return ProcessResponse(metadata=metadata, download_available=is_downloadable)
+        # Let clients that already hold this result revalidate for free. Per
+        # RFC 9110 a matching If-None-Match is a 304 only for GET/HEAD; other
+        # methods must answer 412
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            if request.method in ("GET", "HEAD"):
+                return Response(status_code=304, headers={"ETag": etag})
+            raise HTTPException(status_code=412, detail="Precondition failed.")
+        response.headers["ETag"] = etag
+        # private: the body carries a signed download token for this client
+        response.headers["Cache-Control"] = f"private, max-age={PROCESS_MAX_AGE}"
+        return with_download_token(video_id, result)
     except HTTPException as e:
         raise e
+    except httpx.HTTPError:
+        logger.exception("YouTube Data API request failed for %s", link.url)
+        raise HTTPException(status_code=502, detail="YouTube Data API request failed.")
+    except InvalidLinkError as e:
+        logger.warning("Rejected link %s", link.url)
+        raise HTTPException(status_code=400, detail=f"Error processing request: {str(e)}")
     except Exception as e:
-        logger.error(f"Error processing link: {str(e)}")
+        logger.exception("Error processing link %s", link.url)
         raise HTTPException(status_code=400, detail=f"Error processing request: {str(e)}")
 
+@app.post("/process-links", response_model=list[ProcessLinkResult])
+async def process_links(links: MusicLinks):
+    if not YOUTUBE_API_KEY:
+        logger.error("YOUTUBE_API_KEY is missing during batch request.")
+        raise HTTPException(status_code=500, detail="YOUTUBE_API_KEY environment variable is missing.")
+
+    # Lookups issued together land in the same batch window; each URL gets its
+    # own result or error so one bad link does not fail the whole batch
+    outcomes = await asyncio.gather(
+        *(process_link_item(url) for url in links.urls), return_exceptions=True
+    )
+    items = []
+    for url, outcome in zip(links.urls, outcomes):
+        if isinstance(outcome, ProcessResponse):
+            items.append(ProcessLinkResult(url=url, result=outcome))
+        elif isinstance(outcome, HTTPException):
+            items.append(ProcessLinkResult(url=url, error=outcome.detail))
+        elif isinstance(outcome, httpx.HTTPError):
+            logger.error("YouTube Data API request failed for %s", url, exc_info=outcome)
+            items.append(ProcessLinkResult(url=url, error="YouTube Data API request failed."))
+        elif isinstance(outcome, InvalidLinkError):
+            logger.warning("Rejected link %s", url)
+            items.append(ProcessLinkResult(url=url, error=f"Error processing request: {outcome}"))
+        elif isinstance(outcome, Exception):
+            logger.error("Error processing link %s", url, exc_info=outcome)
+            items.append(ProcessLinkResult(url=url, error=f"Error processing request: {outcome}"))
+        else:
+            raise outcome
+    return items
+
 @app.post("/download")
 async def download(link: MusicLink):
     if not YOUTUBE_API_KEY:
         logger.error("YOUTUBE_API_KEY is missing during download request.")
         raise HTTPException(status_code=500, detail="YOUTUBE_API_KEY environment variable is missing.")
-    if not youtube:
-        logger.error("YouTube Data API client not initialized during download.")
-        raise HTTPException(status_code=500, detail="YouTube Data API client not initialized. Please check YOUTUBE_API_KEY validity.")
 
     try:
-        # Extract video ID
-        if "watch?v=" in link.url:
-            video_id = link.url.split("v=")[1].split("&")[0] if "&" in link.url else link.url.split("v=")[1]
-            video_id = video_id.split("?")[0]
-        else:
-            video_id = link.url.split("/")[-1].split("?")[0]
-
-        # Verify licensing
-        request = youtube.videos().list(part="contentDetails,snippet", id=video_id)
-        response = request.execute()
-        if not response["items"]:
-            raise HTTPException(status_code=404, detail="Video not found")
-        video = response["items"][0]
-
-        licensed_content = video["contentDetails"]["licensedContent"]
-        description_lower = video["snippet"]["description"].lower()
-        is_downloadable = not licensed_content or "creative commons" in description_lower
-
-        if not is_downloadable:
-            raise HTTPException(status_code=403, detail="Video is not licensed for download.")
-
-        # Download with yt-dlp
-        os.makedirs("downloads", exist_ok=True)
-        file_path = f"downloads/{video_id}.mp3"
-        ydl_opts = {
-            "format": "bestaudio[filesize<10M]",
-            "extract_audio": True,
-            "audio_format": "mp3",
-            "outtmpl": file_path,
-            "quiet": True,
-        }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([link.url])
-
-        # Stream the file
-        def iterfile():
-            with open(file_path, "rb") as file:
-                yield from file
-            os.remove(file_path)  # Clean up after streaming
+        video_id = extract_video_id(link.url)
+
+        # Verify licensing, reusing /process-link's cached result or token when present
+        if not has_download_token(video_id, link.download_token):
+            _, result = await get_process_response(video_id)
+            if not result.download_available:
+                raise HTTPException(status_code=403, detail="Video is not licensed for download.")
+
+        # Stream the audio as yt-dlp (and ffmpeg, if present) produce it
+        procs, stream, media_type, ext = await start_audio_pipeline(video_id)
+        first_chunk = await stream.read(STREAM_CHUNK_SIZE)
+        if not first_chunk:
+            await stop_processes(*procs)
+            raise RuntimeError(f"yt-dlp exited with status {procs[0].returncode}")
+
+        async def iterfile():
+            try:
+                chunk = first_chunk
+                while chunk:
+                    yield chunk
+                    chunk = await stream.read(STREAM_CHUNK_SIZE)
+            finally:
+                await stop_processes(*procs)
 
         return StreamingResponse(
             iterfile(),
-            media_type="audio/mpeg",
-            headers={"Content-Disposition": f"attachment; filename={video_id}.mp3"}
+            media_type=media_type,
+            headers={
+                "Content-Disposition": f"attachment; filename={video_id}.{ext}",
+                # Ask reverse proxies not to buffer the chunked body
+                "X-Accel-Buffering": "no",
+            }
         )
     except HTTPException as e:
         raise e
+    except httpx.HTTPError:
+        logger.exception("YouTube Data API request failed for %s", link.url)
+        raise HTTPException(status_code=502, detail="YouTube Data API request failed.")
+    except InvalidLinkError as e:
+        logger.warning("Rejected link %s", link.url)
+        raise HTTPException(status_code=400, detail=f"Error downloading file: {str(e)}")
     except Exception as e:
-        logger.error(f"Error downloading file: {str(e)}")
+        logger.exception("Error downloading file for %s", link.url)
         raise HTTPException(status_code=400, detail=f"Error downloading file: {str(e)}")
 
 # Vercel serverless handler
-handler = Mangum(app)
+# Lifespan is off: the shared client is created lazily and must survive
+# between invocations instead of being rebuilt and closed around each one
+handler = Mangum(app, lifespan="off")
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    import uvicorn
+
+    # Caches, the lookup batcher and (without a shared secret) the download
+    # token key are all per process, so run one worker unless asked otherwise
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    if workers > 1 and not os.getenv("DOWNLOAD_TOKEN_SECRET"):
+        logger.warning(
+            "Running %d workers without DOWNLOAD_TOKEN_SECRET; download tokens "
+            "only validate on the worker that issued them", workers,
+        )
+
+    # uvloop has no Windows build; fall back to the stdlib loop there
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        workers=workers,
+    )